@@ -1,15 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 import io
-import re
+import functools
+import collections
+import bisect
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer, Paragraph, PageBreak, Image
 from reportlab.lib.units import cm
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.enums import TA_LEFT, TA_CENTER
-from io import BytesIO
 
 # --- Dependency Check for Bin Labels ---
 try:
@@ -19,6 +21,13 @@ try:
 except ImportError:
     QR_AVAILABLE = False
 
+# --- Optional Fast Excel Reader ---
+try:
+    import python_calamine
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = None
+
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -46,6 +55,12 @@ location_value_style_v1 = ParagraphStyle(
 location_value_style_v2 = ParagraphStyle(
     name='LocationValue_v2', fontName='Helvetica', fontSize=16, alignment=TA_CENTER, leading=18
 )
+desc_length_limits_v1 = (30, 50, 70, 90)
+desc_font_sizes_v1 = (15, 13, 11, 10, 9)
+desc_styles_v1 = {
+    size: ParagraphStyle(name='Description_v1', fontName='Helvetica', fontSize=size, alignment=TA_LEFT, leading=size + 2)
+    for size in desc_font_sizes_v1
+}
 
 # --- Style Definitions (Bin-Label Specific) ---
 bin_bold_style = ParagraphStyle(name='Bold', fontName='Helvetica-Bold', fontSize=16, alignment=TA_CENTER, leading=14)
@@ -53,6 +68,50 @@ bin_desc_style = ParagraphStyle(name='Description', fontName='Helvetica', fontSi
 bin_qty_style = ParagraphStyle(name='Quantity', fontName='Helvetica', fontSize=11, alignment=TA_CENTER, leading=12)
 
 
+# --- Table Style Definitions (Rack Labels) ---
+part_table_style_v1 = TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black), ('ALIGN', (0, 0), (0, -1), 'CENTER'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('FONTNAME', (0, 0), (0, -1), 'Helvetica'), ('FONTSIZE', (0, 0), (0, -1), 16)])
+part_table_style_v2 = TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black), ('ALIGN', (0, 0), (0, -1), 'CENTER'), ('ALIGN', (1, 1), (1, -1), 'LEFT'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 5), ('FONTNAME', (0, 0), (0, -1), 'Helvetica'), ('FONTSIZE', (0, 0), (0, -1), 16)])
+location_colors = [colors.HexColor('#E9967A'), colors.HexColor('#ADD8E6'), colors.HexColor('#90EE90'), colors.HexColor('#FFD700'), colors.HexColor('#ADD8E6'), colors.HexColor('#E9967A'), colors.HexColor('#90EE90')]
+location_table_style = TableStyle(
+    [('GRID', (0, 0), (-1, -1), 1, colors.black), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')] +
+    [('BACKGROUND', (j+1, 0), (j+1, 0), color) for j, color in enumerate(location_colors)]
+)
+
+# --- Table Style Definitions (Bin Labels) ---
+bin_main_table_style = TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black),('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(0,-1), 'Helvetica'), ('FONTSIZE', (0,0),(0,-1), 11)])
+bin_location_inner_style = TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(-1,-1), 'Helvetica-Bold'), ('FONTSIZE', (0,0),(-1,-1), 9)])
+bin_location_table_style = TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE')])
+bin_mtm_table_style = TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(-1,0), 'Helvetica-Bold'), ('FONTSIZE', (0,0),(-1,-1), 9)])
+bin_bottom_row_style = TableStyle([('VALIGN', (0,0),(-1,-1), 'MIDDLE')])
+
+
+# --- Layout Constants (Rack Labels) ---
+part_col_widths = (4 * cm, 11 * cm)
+part_row_heights_v1 = (1.3 * cm, 0.8 * cm)
+part_row_heights_v2 = (1.9 * cm, 2.1 * cm)
+location_col_props_v1 = (1.8, 2.7, 1.3, 1.3, 1.3, 1.3, 1.3)
+location_widths_v1 = (4 * cm,) + tuple(w * (11 * cm) / sum(location_col_props_v1) for w in location_col_props_v1)
+location_col_props_v2 = (1.7, 2.9, 1.3, 1.2, 1.3, 1.3, 1.3)
+location_widths_v2 = (4 * cm,) + tuple(w * (11 * cm) / sum(location_col_props_v2) for w in location_col_props_v2)
+
+# --- Layout Constants (Bin Labels) ---
+STICKER_WIDTH, STICKER_HEIGHT = 10 * cm, 15 * cm
+CONTENT_BOX_WIDTH, CONTENT_BOX_HEIGHT = 10 * cm, 7.2 * cm
+bin_content_width = CONTENT_BOX_WIDTH - 0.2*cm
+bin_inner_table_width = bin_content_width * 2 / 3
+bin_inner_col_props = (1.8, 2.4, 0.7, 0.7, 0.7, 0.7, 0.9)
+bin_inner_col_widths = tuple(w * bin_inner_table_width / sum(bin_inner_col_props) for w in bin_inner_col_props)
+bin_main_col_widths = (bin_content_width/3, bin_content_width*2/3)
+bin_main_row_heights = (0.9*cm, 1.0*cm, 0.5*cm)
+bin_location_col_widths = (bin_content_width/3, bin_inner_table_width)
+bin_location_row_heights = (0.5*cm,)
+bin_mtm_col_widths = (1.2*cm, 1.2*cm, 1.2*cm)
+bin_mtm_row_heights = (0.75*cm, 0.75*cm)
+bin_mtm_width, bin_qr_width, bin_gap_width = 3.6 * cm, 2.5 * cm, 1.0 * cm
+bin_bottom_col_widths = (bin_mtm_width, bin_gap_width, bin_qr_width, bin_content_width - bin_mtm_width - bin_gap_width - bin_qr_width)
+bin_bottom_row_heights = (2.5*cm,)
+
+
 # --- Formatting Functions (Rack Labels) ---
 def format_part_no_v1(part_no):
     if not part_no or not isinstance(part_no, str): part_no = str(part_no)
@@ -72,9 +131,8 @@ def format_part_no_v2(part_no):
 
 def format_description_v1(desc):
     if not desc or not isinstance(desc, str): desc = str(desc)
-    font_size = 15 if len(desc) <= 30 else 13 if len(desc) <= 50 else 11 if len(desc) <= 70 else 10 if len(desc) <= 90 else 9
-    desc_style_v1 = ParagraphStyle(name='Description_v1', fontName='Helvetica', fontSize=font_size, alignment=TA_LEFT, leading=font_size + 2)
-    return Paragraph(desc, desc_style_v1)
+    font_size = desc_font_sizes_v1[bisect.bisect_left(desc_length_limits_v1, len(desc))]
+    return Paragraph(desc, desc_styles_v1[font_size])
 
 def format_description(desc):
     if not desc or not isinstance(desc, str): desc = str(desc)
@@ -83,219 +141,268 @@ def format_description(desc):
 
 # --- Core Logic Functions (Shared) ---
 def find_required_columns(df):
-    cols_map = {col.strip().upper(): col for col in df.columns}
-    
-    def find_col(patterns):
-        for p in patterns:
-            if p in cols_map:
-                return cols_map[p]
-        return None
-
-    part_no_col = find_col([k for k in cols_map if 'PART' in k and ('NO' in k or 'NUM' in k)])
-    desc_col = find_col([k for k in cols_map if 'DESC' in k])
-    bus_model_col = find_col([k for k in cols_map if 'BUS' in k and 'MODEL' in k])
-    station_no_col = find_col([k for k in cols_map if 'STATION' in k])
-    container_col = find_col([k for k in cols_map if 'CONTAINER' in k])
-    qty_bin_col = find_col([k for k in cols_map if 'QTY/BIN' in k or 'QTY_BIN' in k or ('QTY' in k and 'BIN' in k)])
-    qty_veh_col = find_col([k for k in cols_map if 'QTY/VEH' in k or 'QTY_VEH' in k or ('QTY' in k and 'VEH' in k)])
+    return dict(match_required_columns(tuple(df.columns)))
+
+column_matchers = (
+    ('Part No', lambda k: 'PART' in k and ('NO' in k or 'NUM' in k)),
+    ('Description', lambda k: 'DESC' in k),
+    ('Bus Model', lambda k: 'BUS' in k and 'MODEL' in k),
+    ('Station No', lambda k: 'STATION' in k),
+    ('Container', lambda k: 'CONTAINER' in k),
+    ('Qty/Bin', lambda k: 'QTY/BIN' in k or 'QTY_BIN' in k or ('QTY' in k and 'BIN' in k)),
+    ('Qty/Veh', lambda k: 'QTY/VEH' in k or 'QTY_VEH' in k or ('QTY' in k and 'VEH' in k)),
+)
 
-    return {
-        'Part No': part_no_col, 'Description': desc_col, 'Bus Model': bus_model_col,
-        'Station No': station_no_col, 'Container': container_col, 'Qty/Bin': qty_bin_col,
-        'Qty/Veh': qty_veh_col
-    }
+@functools.lru_cache(maxsize=32)
+def match_required_columns(columns):
+    cols_map = {col.strip().upper(): col for col in columns}
+    found = dict.fromkeys(name for name, _ in column_matchers)
+    # One pass over the normalized names; each role keeps its first matching column.
+    for key, col in cols_map.items():
+        for name, matches in column_matchers:
+            if found[name] is None and matches(key): found[name] = col
+    return found
+
+# Bounded so a long-running server doesn't keep every upload it has ever seen.
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def load_frame(file_name, file_bytes):
+    file_buffer = io.BytesIO(file_bytes)
+    df = pd.read_csv(file_buffer, dtype=str) if file_name.endswith('.csv') else pd.read_excel(file_buffer, dtype=str, engine=EXCEL_ENGINE)
+    df.fillna('', inplace=True)
+    # Containers are derived here so the upload bytes stay the only cache key; hashing the frame on every rerun costs more than unique().
+    return df, get_unique_containers(df, find_required_columns(df)['Container'])
 
 def get_unique_containers(df, container_col):
     if not container_col or container_col not in df.columns: return []
-    return sorted(df[container_col].dropna().astype(str).unique())
+    return sorted({str(c) for c in df[container_col].dropna().unique()})
 
-def automate_location_assignment(df, base_rack_id, rack_configs, status_text=None):
-    required_cols = find_required_columns(df)
+def lexsort_order(df, columns):
+    # Sorted factorize codes keep each column's string order, so one stable lexsort over small ints matches sort_values.
+    codes = [pd.factorize(df[col], sort=True, use_na_sentinel=False)[0] for col in reversed(columns)]
+    return np.lexsort(codes)
+
+def automate_location_assignment(df, base_rack_id, rack_configs, status_text=None, required_cols=None):
+    if required_cols is None: required_cols = find_required_columns(df)
     
     if not all([required_cols['Part No'], required_cols['Container'], required_cols['Station No']]):
         st.error("❌ 'Part Number', 'Container Type', or 'Station No' column not found.")
         return None
 
-    df_processed = df.copy()
     rename_dict = {v: k for k, v in required_cols.items() if v}
-    df_processed.rename(columns=rename_dict, inplace=True)
-    df_processed.sort_values(by=['Station No', 'Container'], inplace=True)
+    df_processed = df.rename(columns=rename_dict)
+    df_processed = df_processed.take(lexsort_order(df_processed, ['Station No', 'Container'])).reset_index(drop=True)
 
-    final_parts_list = []
+    # Output is built column-wise: source row position per slot (-1 for EMPTY) plus the location columns.
+    source_rows, out_station, out_container = [], [], []
+    out_rack_1st, out_rack_2nd, out_level, out_cell = [], [], [], []
+    
+    sorted_racks = sorted(rack_configs.items())
+    max_capacity = max((c for _, config in sorted_racks for c in config.get('rack_bin_counts', {}).values()), default=0)
+    cell_labels = [str(cell_idx) for cell_idx in range(1, max_capacity + 1)]
+    level_offsets = np.cumsum([0] + [len(config.get('levels', [])) for _, config in sorted_racks]).tolist()
+    rack_digits = {}
+    for rack_name, _ in sorted_racks:
+        rack_num_val = ''.join(filter(str.isdigit, rack_name))
+        rack_digits[rack_name] = (rack_num_val[0], rack_num_val[1]) if len(rack_num_val) > 1 else ('0', rack_num_val[0])
+    container_plans = {}
+
+    def build_container_plan(container_type):
+        # Every rack level that takes this container, in fill order, with running capacity totals.
+        slots, levels_info = [], []
+        for rack_pos, (rack_name, config) in enumerate(sorted_racks):
+            levels, capacity = config.get('levels', []), config.get('rack_bin_counts', {}).get(container_type, 0)
+            if capacity <= 0 or not levels: continue
+            rack_num_1st, rack_num_2nd = rack_digits[rack_name]
+            for level_pos, level in enumerate(levels):
+                slots.append(level_offsets[rack_pos] + level_pos)
+                levels_info.append((rack_num_1st, rack_num_2nd, level, capacity))
+        capacities = np.array([info[3] for info in levels_info], dtype=np.int64)
+        return np.array(slots, dtype=np.int64), np.cumsum(capacities), levels_info
+
+    current_station = None
+
+    for (station_no, container_type), group_rows in df_processed.groupby(['Station No', 'Container'], sort=True).indices.items():
+        if station_no != current_station:
+            current_station = station_no
+            if status_text: status_text.text(f"Processing station: {station_no}...")
+            next_slot = 0
+
+        if container_type not in container_plans: container_plans[container_type] = build_container_plan(container_type)
+        slots, cum_capacity, levels_info = container_plans[container_type]
+
+        # First usable level at or after the station's fill position, then as many levels as the group needs.
+        first = int(np.searchsorted(slots, next_slot))
+        used_before = int(cum_capacity[first - 1]) if first > 0 else 0
+        last = min(int(np.searchsorted(cum_capacity, used_before + len(group_rows))) + 1, len(slots))
+
+        total_slots = int(cum_capacity[last - 1]) - used_before if first < last else 0
+        if total_slots:
+            placed_rows = group_rows[:total_slots].tolist()
+            source_rows.extend(placed_rows + [-1] * (total_slots - len(placed_rows)))
+            out_station.extend([station_no] * total_slots)
+            out_container.extend([container_type] * total_slots)
+            for rack_num_1st, rack_num_2nd, level, level_capacity in levels_info[first:last]:
+                out_rack_1st.extend([rack_num_1st] * level_capacity)
+                out_rack_2nd.extend([rack_num_2nd] * level_capacity)
+                out_level.extend([level] * level_capacity)
+                out_cell.extend(cell_labels[:level_capacity])
+            next_slot = int(slots[last - 1]) + 1
+
+        if total_slots < len(group_rows):
+            st.warning(f"⚠️ Ran out of rack space at Station {station_no} for '{container_type}'.")
     
-    for station_no, station_group in df_processed.groupby('Station No', sort=False):
-        if status_text: status_text.text(f"Processing station: {station_no}...")
+    if not source_rows: return pd.DataFrame()
+
+    source_rows = np.array(source_rows)
+    final_df = df_processed.reindex(source_rows, fill_value='').reset_index(drop=True)
+    final_df.loc[source_rows < 0, 'Part No'] = 'EMPTY'
+    final_df['Station No'] = out_station
+    final_df['Container'] = out_container
+    final_df['Rack'] = base_rack_id
+    final_df['Rack No 1st'] = out_rack_1st
+    final_df['Rack No 2nd'] = out_rack_2nd
+    final_df['Level'] = out_level
+    final_df['Cell'] = out_cell
+    return final_df
+
+def location_sort_order(df):
+    return lexsort_order(df, ['Station No', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'])
+
+def get_location_ranges(df):
+    # Rows of one location are adjacent once sorted, so each location is a (start, end) run of equal key columns.
+    keys = df.reindex(columns=['Station No', 'Rack', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'], fill_value='').fillna('').astype(str).to_numpy(dtype=object)
+    if not len(keys): return []
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    return list(zip(starts.tolist(), np.r_[starts[1:], len(keys)].tolist()))
+
+def count_rack_labels(df, rows=None):
+    rack_keys = ('ST-' + df['Station No'].astype(str) + ' / Rack ' + df['Rack No 1st'].astype(str) + df['Rack No 2nd'].astype(str)).to_numpy()
+    return collections.Counter((rack_keys if rows is None else rack_keys[rows]).tolist())
+
+def extract_location_values(df):
+    location_cols = df.reindex(columns=['Bus Model', 'Station No', 'Rack', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'], fill_value='')
+    return location_cols.to_numpy(dtype=object).astype(str).tolist()
+
+
+# --- PDF Generation (Shared) ---
+class FlowableStream(list):
+    # doc.build() consumes its story from the front while len() is non-zero, so topping the list
+    # up from a generator keeps only a small window of flowables alive instead of every label.
+    def __init__(self, flowables, window=64):
+        super().__init__()
+        self.source = iter(flowables)
+        self.window = window
+
+    def __len__(self):
+        while list.__len__(self) < self.window:
+            flowable = next(self.source, None)
+            if flowable is None: break
+            self.append(flowable)
+        return list.__len__(self)
+
+    def is_exhausted(self):
+        if list.__len__(self): return False
+        flowable = next(self.source, None)
+        if flowable is None: return True
+        self.append(flowable)
+        return False
+
+def build_streamed(doc, flowables, **build_kwargs):
+    story = FlowableStream(flowables)
+    if not story: return
+    doc.build(story, **build_kwargs)
+    # The window relies on build() draining the story through len(); fail loudly rather than ship a truncated PDF.
+    if not story.is_exhausted():
+        raise RuntimeError("PDF build stopped before all labels were rendered.")
 
-        rack_idx, level_idx = 0, 0
-        sorted_racks = sorted(rack_configs.items())
 
-        for container_type, parts_group in station_group.groupby('Container', sort=True):
-            items_to_place = parts_group.to_dict('records')
-            
-            while items_to_place:
-                slot_found = False
-                search_rack_idx, search_level_idx = rack_idx, level_idx
-                while search_rack_idx < len(sorted_racks):
-                    rack_name, config = sorted_racks[search_rack_idx]
-                    levels, capacity = config.get('levels', []), config.get('rack_bin_counts', {}).get(container_type, 0)
-
-                    if capacity > 0 and search_level_idx < len(levels):
-                        slot_found = True
-                        rack_idx, level_idx = search_rack_idx, search_level_idx
-                        break
-                    
-                    search_level_idx = 0
-                    search_rack_idx += 1
-                
-                if not slot_found:
-                    st.warning(f"⚠️ Ran out of rack space at Station {station_no} for '{container_type}'.")
-                    break
-
-                rack_name, config = sorted_racks[rack_idx]
-                levels = config.get('levels', [])
-                level_capacity = config.get('rack_bin_counts', {}).get(container_type, 0)
-
-                parts_for_level = items_to_place[:level_capacity]
-                items_to_place = items_to_place[level_capacity:]
-                
-                num_empty_slots = level_capacity - len(parts_for_level)
-                level_items = parts_for_level + ([{'Part No': 'EMPTY'}] * num_empty_slots)
-                
-                item_template = {col: '' for col in df_processed.columns}
-
-                for cell_idx, item in enumerate(level_items, 1):
-                    rack_num_val = ''.join(filter(str.isdigit, rack_name))
-                    rack_num_1st = rack_num_val[0] if len(rack_num_val) > 1 else '0'
-                    rack_num_2nd = rack_num_val[1] if len(rack_num_val) > 1 else rack_num_val[0]
-                    
-                    location_info = {
-                        'Rack': base_rack_id, 'Rack No 1st': rack_num_1st, 'Rack No 2nd': rack_num_2nd,
-                        'Level': levels[level_idx], 'Cell': str(cell_idx), 'Station No': station_no
-                    }
-
-                    if item['Part No'] == 'EMPTY':
-                        full_item = item_template.copy()
-                        full_item.update({'Part No': 'EMPTY', 'Container': container_type})
-                    else:
-                        full_item = item
+# --- PDF Generation (Rack Labels) ---
+def generate_rack_labels_v1(df, progress_bar=None, status_text=None):
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*cm, bottomMargin=1*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
 
-                    full_item.update(location_info)
-                    final_parts_list.append(full_item)
+    df = df.take(location_sort_order(df))
+    label_rows = list(df.reindex(columns=['Part No', 'Description'], fill_value='').itertuples(index=False, name=None))
+    location_values = extract_location_values(df)
+    # Only locations whose first part is real get a label, so EMPTY ones are dropped before the loop.
+    has_part = (df['Part No'].astype(str).str.upper() != 'EMPTY').to_numpy()
+    location_ranges = [(start, end) for start, end in get_location_ranges(df) if has_part[start]]
+    total_locations = len(location_ranges)
+    progress_step = max(1, total_locations // 100)
+    label_summary = count_rack_labels(df, [start for start, _ in location_ranges])
+    # Paragraphs hold the canvas while they draw, so repeats are shared within this document only, never across sessions.
+    format_part, format_desc = functools.cache(format_part_no_v1), functools.cache(format_description_v1)
+    location_header = Paragraph('Line Location', location_header_style)
 
-                level_idx += 1
-                if level_idx >= len(levels):
-                    level_idx = 0
-                    rack_idx += 1
-    
-    if not final_parts_list: return pd.DataFrame()
-    return pd.DataFrame(final_parts_list)
+    def label_flowables():
+        for i, (start, end) in enumerate(location_ranges):
+            if i % progress_step == 0:
+                if progress_bar: progress_bar.progress(int((i / total_locations) * 100))
+                if status_text: status_text.text(f"Processing Rack Label {i+1}/{total_locations}")
 
-def create_location_key(row):
-    return '_'.join([str(row.get(c, '')) for c in ['Station No', 'Rack', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell']])
+            part_no, desc = label_rows[start]
 
-def extract_location_values(row):
-    return [str(row.get(c, '')) for c in ['Bus Model', 'Station No', 'Rack', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell']]
+            if i > 0 and i % 4 == 0: yield PageBreak()
 
+            part_no2, desc2 = label_rows[start + 1] if end - start > 1 else (part_no, desc)
 
-# --- PDF Generation (Rack Labels) ---
-def generate_rack_labels_v1(df, progress_bar=None, status_text=None):
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*cm, bottomMargin=1*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
-    elements = []
-    
-    df['location_key'] = df.apply(create_location_key, axis=1)
-    df.sort_values(by=['Station No', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'], inplace=True)
-    df_grouped = df.groupby('location_key')
-    total_locations = len(df_grouped)
-    label_count = 0
-    label_summary = {}
-
-    for i, (location_key, group) in enumerate(df_grouped):
-        if progress_bar: progress_bar.progress(int((i / total_locations) * 100))
-        if status_text: status_text.text(f"Processing Rack Label {i+1}/{total_locations}")
-        
-        part1 = group.iloc[0].to_dict()
-        if str(part1.get('Part No', '')).upper() == 'EMPTY': continue
-
-        rack_key = f"ST-{part1.get('Station No', 'NA')} / Rack {part1.get('Rack No 1st', '0')}{part1.get('Rack No 2nd', '0')}"
-        label_summary[rack_key] = label_summary.get(rack_key, 0) + 1
-
-        if label_count > 0 and label_count % 4 == 0: elements.append(PageBreak())
-        
-        part2 = group.iloc[1].to_dict() if len(group) > 1 else part1
-        
-        part_table1 = Table([['Part No', format_part_no_v1(str(part1.get('Part No','')))], ['Description', format_description_v1(str(part1.get('Description','')))]], colWidths=[4*cm, 11*cm], rowHeights=[1.3*cm, 0.8*cm])
-        part_table2 = Table([['Part No', format_part_no_v1(str(part2.get('Part No','')))], ['Description', format_description_v1(str(part2.get('Description','')))]], colWidths=[4*cm, 11*cm], rowHeights=[1.3*cm, 0.8*cm])
-        
-        location_values = extract_location_values(part1)
-        location_data = [[Paragraph('Line Location', location_header_style)] + [Paragraph(str(val), location_value_style_v1) for val in location_values]]
-        
-        col_props = [1.8, 2.7, 1.3, 1.3, 1.3, 1.3, 1.3]
-        location_widths = [4 * cm] + [w * (11 * cm) / sum(col_props) for w in col_props]
-        location_table = Table(location_data, colWidths=location_widths, rowHeights=0.8*cm)
-        
-        part_style = TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black), ('ALIGN', (0, 0), (0, -1), 'CENTER'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('FONTNAME', (0, 0), (0, -1), 'Helvetica'), ('FONTSIZE', (0, 0), (0, -1), 16)])
-        part_table1.setStyle(part_style)
-        part_table2.setStyle(part_style)
-        
-        loc_colors = [colors.HexColor('#E9967A'), colors.HexColor('#ADD8E6'), colors.HexColor('#90EE90'), colors.HexColor('#FFD700'), colors.HexColor('#ADD8E6'), colors.HexColor('#E9967A'), colors.HexColor('#90EE90')]
-        loc_style_cmds = [('GRID', (0, 0), (-1, -1), 1, colors.black), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')]
-        for j, color in enumerate(loc_colors):
-            loc_style_cmds.append(('BACKGROUND', (j+1, 0), (j+1, 0), color))
-        location_table.setStyle(TableStyle(loc_style_cmds))
-        
-        elements.extend([part_table1, Spacer(1, 0.3 * cm), part_table2, Spacer(1, 0.3 * cm), location_table, Spacer(1, 0.2 * cm)])
-        label_count += 1
-        
-    if elements: doc.build(elements)
+            part_table1 = Table([['Part No', format_part(str(part_no))], ['Description', format_desc(str(desc))]], colWidths=part_col_widths, rowHeights=part_row_heights_v1)
+            part_table2 = Table([['Part No', format_part(str(part_no2))], ['Description', format_desc(str(desc2))]], colWidths=part_col_widths, rowHeights=part_row_heights_v1)
+
+            location_data = [[location_header] + [Paragraph(str(val), location_value_style_v1) for val in location_values[start]]]
+
+            location_table = Table(location_data, colWidths=location_widths_v1, rowHeights=0.8*cm)
+
+            part_table1.setStyle(part_table_style_v1)
+            part_table2.setStyle(part_table_style_v1)
+
+            location_table.setStyle(location_table_style)
+
+            yield from [part_table1, Spacer(1, 0.3 * cm), part_table2, Spacer(1, 0.3 * cm), location_table, Spacer(1, 0.2 * cm)]
+
+    build_streamed(doc, label_flowables())
     buffer.seek(0)
     return buffer, label_summary
 
 def generate_rack_labels_v2(df, progress_bar=None, status_text=None):
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=1*cm, bottomMargin=1*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
-    elements = []
-    
-    df['location_key'] = df.apply(create_location_key, axis=1)
-    df.sort_values(by=['Station No', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'], inplace=True)
-    df_grouped = df.groupby('location_key')
-    total_locations = len(df_grouped)
-    label_count = 0
-    label_summary = {}
-
-    for i, (location_key, group) in enumerate(df_grouped):
-        if progress_bar: progress_bar.progress(int((i / total_locations) * 100))
-        if status_text: status_text.text(f"Processing Rack Label {i+1}/{total_locations}")
-
-        part1 = group.iloc[0].to_dict()
-        if str(part1.get('Part No', '')).upper() == 'EMPTY': continue
-        
-        rack_key = f"ST-{part1.get('Station No', 'NA')} / Rack {part1.get('Rack No 1st', '0')}{part1.get('Rack No 2nd', '0')}"
-        label_summary[rack_key] = label_summary.get(rack_key, 0) + 1
-            
-        if label_count > 0 and label_count % 4 == 0: elements.append(PageBreak())
-
-        part_table = Table([['Part No', format_part_no_v2(str(part1.get('Part No','')))], ['Description', format_description(str(part1.get('Description','')))]], colWidths=[4*cm, 11*cm], rowHeights=[1.9*cm, 2.1*cm])
-        
-        location_values = extract_location_values(part1)
-        location_data = [[Paragraph('Line Location', location_header_style)] + [Paragraph(str(val), location_value_style_v2) for val in location_values]]
-
-        col_widths = [1.7, 2.9, 1.3, 1.2, 1.3, 1.3, 1.3]
-        location_widths = [4 * cm] + [w * (11 * cm) / sum(col_widths) for w in col_widths]
-        location_table = Table(location_data, colWidths=location_widths, rowHeights=0.9*cm)
-        
-        part_table.setStyle(TableStyle([('GRID', (0, 0), (-1, -1), 1, colors.black), ('ALIGN', (0, 0), (0, -1), 'CENTER'), ('ALIGN', (1, 1), (1, -1), 'LEFT'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 5), ('FONTNAME', (0, 0), (0, -1), 'Helvetica'), ('FONTSIZE', (0, 0), (0, -1), 16)]))
-        
-        loc_colors = [colors.HexColor('#E9967A'), colors.HexColor('#ADD8E6'), colors.HexColor('#90EE90'), colors.HexColor('#FFD700'), colors.HexColor('#ADD8E6'), colors.HexColor('#E9967A'), colors.HexColor('#90EE90')]
-        loc_style_cmds = [('GRID', (0, 0), (-1, -1), 1, colors.black), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')]
-        for j, color in enumerate(loc_colors):
-            loc_style_cmds.append(('BACKGROUND', (j+1, 0), (j+1, 0), color))
-        location_table.setStyle(TableStyle(loc_style_cmds))
-        
-        elements.extend([part_table, Spacer(1, 0.3 * cm), location_table, Spacer(1, 0.2 * cm)])
-        label_count += 1
-        
-    if elements: doc.build(elements)
+
+    df = df.take(location_sort_order(df))
+    label_rows = list(df.reindex(columns=['Part No', 'Description'], fill_value='').itertuples(index=False, name=None))
+    location_values = extract_location_values(df)
+    # Only locations whose first part is real get a label, so EMPTY ones are dropped before the loop.
+    has_part = (df['Part No'].astype(str).str.upper() != 'EMPTY').to_numpy()
+    location_ranges = [(start, end) for start, end in get_location_ranges(df) if has_part[start]]
+    total_locations = len(location_ranges)
+    progress_step = max(1, total_locations // 100)
+    label_summary = count_rack_labels(df, [start for start, _ in location_ranges])
+    format_part, format_desc = functools.cache(format_part_no_v2), functools.cache(format_description)
+    location_header = Paragraph('Line Location', location_header_style)
+
+    def label_flowables():
+        for i, (start, end) in enumerate(location_ranges):
+            if i % progress_step == 0:
+                if progress_bar: progress_bar.progress(int((i / total_locations) * 100))
+                if status_text: status_text.text(f"Processing Rack Label {i+1}/{total_locations}")
+
+            part_no, desc = label_rows[start]
+
+            if i > 0 and i % 4 == 0: yield PageBreak()
+
+            part_table = Table([['Part No', format_part(str(part_no))], ['Description', format_desc(str(desc))]], colWidths=part_col_widths, rowHeights=part_row_heights_v2)
+
+            location_data = [[location_header] + [Paragraph(str(val), location_value_style_v2) for val in location_values[start]]]
+
+            location_table = Table(location_data, colWidths=location_widths_v2, rowHeights=0.9*cm)
+
+            part_table.setStyle(part_table_style_v2)
+
+            location_table.setStyle(location_table_style)
+
+            yield from [part_table, Spacer(1, 0.3 * cm), location_table, Spacer(1, 0.2 * cm)]
+
+    build_streamed(doc, label_flowables())
     buffer.seek(0)
     return buffer, label_summary
 
@@ -307,15 +414,15 @@ def generate_qr_code_image(data_string):
     qr.add_data(data_string)
     qr.make(fit=True)
     qr_img = qr.make_image(fill_color="black", back_color="white")
-    img_buffer = BytesIO()
+    img_buffer = io.BytesIO()
     qr_img.save(img_buffer, format='PNG')
     img_buffer.seek(0)
     return Image(img_buffer, width=2.5*cm, height=2.5*cm)
 
-def detect_bus_model_and_qty(row):
+def detect_bus_model_and_qty(bus_model, qty_veh):
     result = {'7M': '', '9M': '', '12M': ''}
-    qty_veh = str(row.get('Qty/Veh', ''))
-    bus_model = str(row.get('Bus Model', '')).upper()
+    qty_veh = str(qty_veh)
+    bus_model = str(bus_model).upper()
     
     if not qty_veh: return result
 
@@ -328,28 +435,29 @@ def detect_bus_model_and_qty(row):
         result[detected_model] = qty_veh
     return result
 
-def extract_store_location_data_from_excel(row_data):
-    col_lookup = {str(k).strip().upper(): k for k in row_data.keys()}
-
-    def get_clean_value(possible_names, default=''):
-        for name in possible_names:
-            clean_name = name.strip().upper()
-            if clean_name in col_lookup:
-                original_col_name = col_lookup[clean_name]
-                val = row_data.get(original_col_name)
-                if pd.notna(val) and str(val).strip().lower() not in ['nan', 'none', 'null', '']:
-                    return str(val).strip()
-        return default
-
-    store_location = get_clean_value(['Store Location', 'STORELOCATION', 'Store_Location'])
-    zone = get_clean_value(['ABB ZONE', 'ABB_ZONE', 'ABBZONE'])
-    location = get_clean_value(['ABB LOCATION', 'ABB_LOCATION', 'ABBLOCATION'])
-    floor = get_clean_value(['ABB FLOOR', 'ABB_FLOOR', 'ABBFLOOR'])
-    rack_no = get_clean_value(['ABB RACK NO', 'ABB_RACK_NO', 'ABBRACKNO'])
-    level_in_rack = get_clean_value(['ABB LEVEL IN RACK', 'ABB_LEVEL_IN_RACK', 'ABBLEVELINRACK'])
-    
-    station_name = '' 
-    return [station_name, store_location, zone, location, floor, rack_no, level_in_rack]
+def extract_store_location_values(df):
+    col_lookup = {str(k).strip().upper(): k for k in df.columns}
+
+    def get_clean_values(possible_names):
+        # Earlier names win per row, so fill from the last candidate column back to the first.
+        values = pd.Series('', index=df.index, dtype=object)
+        for name in reversed(possible_names):
+            col = col_lookup.get(name.strip().upper())
+            if col is None: continue
+            cleaned = df[col].astype(str).str.strip()
+            valid = df[col].notna() & ~cleaned.str.lower().isin(['nan', 'none', 'null', ''])
+            values = cleaned.where(valid, values)
+        return values
+
+    store_location = get_clean_values(['Store Location', 'STORELOCATION', 'Store_Location'])
+    zone = get_clean_values(['ABB ZONE', 'ABB_ZONE', 'ABBZONE'])
+    location = get_clean_values(['ABB LOCATION', 'ABB_LOCATION', 'ABBLOCATION'])
+    floor = get_clean_values(['ABB FLOOR', 'ABB_FLOOR', 'ABBFLOOR'])
+    rack_no = get_clean_values(['ABB RACK NO', 'ABB_RACK_NO', 'ABBRACKNO'])
+    level_in_rack = get_clean_values(['ABB LEVEL IN RACK', 'ABB_LEVEL_IN_RACK', 'ABBLEVELINRACK'])
+
+    station_name = [''] * len(df)
+    return [list(values) for values in zip(station_name, store_location.tolist(), zone.tolist(), location.tolist(), floor.tolist(), rack_no.tolist(), level_in_rack.tolist())]
 
 # --- PDF Generation (Bin Labels Main Function) ---
 def generate_bin_labels(df, progress_bar=None, status_text=None):
@@ -357,19 +465,16 @@ def generate_bin_labels(df, progress_bar=None, status_text=None):
         st.error("❌ QR Code library not found. Please install `qrcode` and `Pillow`.")
         return None, {}
 
-    STICKER_WIDTH, STICKER_HEIGHT = 10 * cm, 15 * cm
-    CONTENT_BOX_WIDTH, CONTENT_BOX_HEIGHT = 10 * cm, 7.2 * cm
-    
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=(STICKER_WIDTH, STICKER_HEIGHT),
                             topMargin=0.2*cm, bottomMargin=STICKER_HEIGHT - CONTENT_BOX_HEIGHT - 0.2*cm,
                             leftMargin=0.1*cm, rightMargin=0.1*cm)
 
-    df_filtered = df[df['Part No'].str.upper() != 'EMPTY'].copy()
-    df_filtered.sort_values(by=['Station No', 'Rack No 1st', 'Rack No 2nd', 'Level', 'Cell'], inplace=True)
+    df_filtered = df[df['Part No'].str.upper() != 'EMPTY']
+    df_filtered = df_filtered.take(location_sort_order(df_filtered))
     total_labels = len(df_filtered)
-    label_summary = {}
-    all_elements = []
+    progress_step = max(1, total_labels // 100)
+    label_summary = count_rack_labels(df_filtered)
 
     def draw_border(canvas, doc):
         canvas.saveState()
@@ -380,70 +485,64 @@ def generate_bin_labels(df, progress_bar=None, status_text=None):
         canvas.rect(x_offset + doc.leftMargin, y_offset, CONTENT_BOX_WIDTH - 0.2*cm, CONTENT_BOX_HEIGHT)
         canvas.restoreState()
 
-    for i, row in enumerate(df_filtered.to_dict('records')):
-        if progress_bar: progress_bar.progress(int(((i+1) / total_labels) * 100))
-        if status_text: status_text.text(f"Processing Bin Label {i+1}/{total_labels}")
-        
-        rack_key = f"ST-{row.get('Station No', 'NA')} / Rack {row.get('Rack No 1st', '0')}{row.get('Rack No 2nd', '0')}"
-        label_summary[rack_key] = label_summary.get(rack_key, 0) + 1
-
-        part_no = str(row.get('Part No', ''))
-        desc = str(row.get('Description', ''))
-        qty_bin = str(row.get('Qty/Bin', ''))
-
-        qr_data = f"Part No: {part_no}\nDesc: {desc}\nLine Loc: {'_'.join(extract_location_values(row))}"
-        qr_image = generate_qr_code_image(qr_data)
-        
-        content_width = CONTENT_BOX_WIDTH - 0.2*cm
-        
-        main_table = Table([
-            ["Part No", Paragraph(f"{part_no}", bin_bold_style)],
-            ["Description", Paragraph(desc[:47] + "..." if len(desc) > 50 else desc, bin_desc_style)],
-            ["Qty/Bin", Paragraph(qty_bin, bin_qty_style)]
-        ], colWidths=[content_width/3, content_width*2/3], rowHeights=[0.9*cm, 1.0*cm, 0.5*cm])
-        main_table.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black),('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(0,-1), 'Helvetica'), ('FONTSIZE', (0,0),(0,-1), 11)]))
-
-        inner_table_width = content_width * 2 / 3
-        col_props = [1.8, 2.4, 0.7, 0.7, 0.7, 0.7, 0.9]
-        inner_col_widths = [w * inner_table_width / sum(col_props) for w in col_props]
-        
-        store_loc_values = extract_store_location_data_from_excel(row)
-        store_loc_inner = Table([store_loc_values], colWidths=inner_col_widths, rowHeights=[0.5*cm])
-        store_loc_inner.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(-1,-1), 'Helvetica-Bold'), ('FONTSIZE', (0,0),(-1,-1), 9)]))
-        store_loc_table = Table([[Paragraph("Store Location", bin_desc_style), store_loc_inner]], colWidths=[content_width/3, inner_table_width], rowHeights=[0.5*cm])
-        store_loc_table.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE')]))
-        
-        line_loc_values = extract_location_values(row)
-        line_loc_inner = Table([line_loc_values], colWidths=inner_col_widths, rowHeights=[0.5*cm])
-        line_loc_inner.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(-1,-1), 'Helvetica-Bold'), ('FONTSIZE', (0,0),(-1,-1), 9)]))
-        line_loc_table = Table([[Paragraph("Line Location", bin_desc_style), line_loc_inner]], colWidths=[content_width/3, inner_table_width], rowHeights=[0.5*cm])
-        line_loc_table.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE')]))
-
-        mtm_quantities = detect_bus_model_and_qty(row)
-        mtm_data = [
-            ["7M", "9M", "12M"],
-            [Paragraph(f"<b>{mtm_quantities['7M']}</b>", bin_qty_style) if mtm_quantities['7M'] else "",
-             Paragraph(f"<b>{mtm_quantities['9M']}</b>", bin_qty_style) if mtm_quantities['9M'] else "",
-             Paragraph(f"<b>{mtm_quantities['12M']}</b>", bin_qty_style) if mtm_quantities['12M'] else ""]
-        ]
-        mtm_table = Table(mtm_data, colWidths=[1.2*cm, 1.2*cm, 1.2*cm], rowHeights=[0.75*cm, 0.75*cm])
-        mtm_table.setStyle(TableStyle([('GRID', (0,0),(-1,-1), 1.2, colors.black), ('ALIGN', (0,0),(-1,-1), 'CENTER'), ('VALIGN', (0,0),(-1,-1), 'MIDDLE'), ('FONTNAME', (0,0),(-1,0), 'Helvetica-Bold'), ('FONTSIZE', (0,0),(-1,-1), 9)]))
-
-        mtm_width, qr_width, gap_width = 3.6 * cm, 2.5 * cm, 1.0 * cm
-        remaining_width = content_width - mtm_width - gap_width - qr_width
-        
-        bottom_row = Table(
-            [[mtm_table, "", qr_image or "", ""]],
-            colWidths=[mtm_width, gap_width, qr_width, remaining_width],
-            rowHeights=[2.5*cm]
-        )
-        bottom_row.setStyle(TableStyle([('VALIGN', (0,0),(-1,-1), 'MIDDLE')]))
-
-        all_elements.extend([main_table, store_loc_table, line_loc_table, Spacer(1, 0.2*cm), bottom_row])
-        if i < total_labels - 1:
-            all_elements.append(PageBreak())
-
-    if all_elements: doc.build(all_elements, onFirstPage=draw_border, onLaterPages=draw_border)
+    label_rows = list(df_filtered.reindex(columns=['Part No', 'Description', 'Qty/Bin', 'Bus Model', 'Qty/Veh'], fill_value='').itertuples(index=False, name=None))
+    location_values = extract_location_values(df_filtered)
+    store_location_values = extract_store_location_values(df_filtered)
+    # Header cells are shared by every sticker in this document; Paragraphs must not be shared across sessions.
+    store_location_header = Paragraph("Store Location", bin_desc_style)
+    line_location_header = Paragraph("Line Location", bin_desc_style)
+
+    def label_flowables():
+        for i, (part_no, desc, qty_bin, bus_model, qty_veh) in enumerate(label_rows):
+            if i % progress_step == 0:
+                if progress_bar: progress_bar.progress(int(((i+1) / total_labels) * 100))
+                if status_text: status_text.text(f"Processing Bin Label {i+1}/{total_labels}")
+
+            part_no, desc, qty_bin = str(part_no), str(desc), str(qty_bin)
+
+            line_loc_values = location_values[i]
+            qr_data = f"Part No: {part_no}\nDesc: {desc}\nLine Loc: {'_'.join(line_loc_values)}"
+            qr_image = generate_qr_code_image(qr_data)
+
+            main_table = Table([
+                ["Part No", Paragraph(f"{part_no}", bin_bold_style)],
+                ["Description", Paragraph(desc[:47] + "..." if len(desc) > 50 else desc, bin_desc_style)],
+                ["Qty/Bin", Paragraph(qty_bin, bin_qty_style)]
+            ], colWidths=bin_main_col_widths, rowHeights=bin_main_row_heights)
+            main_table.setStyle(bin_main_table_style)
+
+            store_loc_inner = Table([store_location_values[i]], colWidths=bin_inner_col_widths, rowHeights=bin_location_row_heights)
+            store_loc_inner.setStyle(bin_location_inner_style)
+            store_loc_table = Table([[store_location_header, store_loc_inner]], colWidths=bin_location_col_widths, rowHeights=bin_location_row_heights)
+            store_loc_table.setStyle(bin_location_table_style)
+
+            line_loc_inner = Table([line_loc_values], colWidths=bin_inner_col_widths, rowHeights=bin_location_row_heights)
+            line_loc_inner.setStyle(bin_location_inner_style)
+            line_loc_table = Table([[line_location_header, line_loc_inner]], colWidths=bin_location_col_widths, rowHeights=bin_location_row_heights)
+            line_loc_table.setStyle(bin_location_table_style)
+
+            mtm_quantities = detect_bus_model_and_qty(bus_model, qty_veh)
+            mtm_data = [
+                ["7M", "9M", "12M"],
+                [Paragraph(f"<b>{mtm_quantities['7M']}</b>", bin_qty_style) if mtm_quantities['7M'] else "",
+                 Paragraph(f"<b>{mtm_quantities['9M']}</b>", bin_qty_style) if mtm_quantities['9M'] else "",
+                 Paragraph(f"<b>{mtm_quantities['12M']}</b>", bin_qty_style) if mtm_quantities['12M'] else ""]
+            ]
+            mtm_table = Table(mtm_data, colWidths=bin_mtm_col_widths, rowHeights=bin_mtm_row_heights)
+            mtm_table.setStyle(bin_mtm_table_style)
+
+            bottom_row = Table(
+                [[mtm_table, "", qr_image or "", ""]],
+                colWidths=bin_bottom_col_widths,
+                rowHeights=bin_bottom_row_heights
+            )
+            bottom_row.setStyle(bin_bottom_row_style)
+
+            yield from [main_table, store_loc_table, line_loc_table, Spacer(1, 0.2*cm), bottom_row]
+            if i < total_labels - 1:
+                yield PageBreak()
+
+    build_streamed(doc, label_flowables(), onFirstPage=draw_border, onLaterPages=draw_border)
     buffer.seek(0)
     return buffer, label_summary
 
@@ -469,51 +568,53 @@ def main():
 
     if uploaded_file:
         try:
-            df = pd.read_csv(uploaded_file, dtype=str) if uploaded_file.name.endswith('.csv') else pd.read_excel(uploaded_file, dtype=str)
-            df.fillna('', inplace=True)
+            df, unique_containers = load_frame(uploaded_file.name, uploaded_file.getvalue())
             st.success(f"✅ File loaded! Found {len(df)} rows.")
             
             required_cols_check = find_required_columns(df)
             
             if required_cols_check['Container']:
-                unique_containers = get_unique_containers(df, required_cols_check['Container'])
-                
-                with st.expander("⚙️ Step 1: Configure Dimensions and Rack Setup (Applied to Each Station)", expanded=True):
-                    
-                    st.subheader("1. Container Dimensions")
-                    bin_dims = {}
-                    for container in unique_containers:
-                        dim = st.text_input(f"Dimensions for {container}", key=f"bindim_{container}", placeholder="e.g., 300x200x150mm")
-                        bin_dims[container] = dim
-                    st.markdown("---")
-
-                    st.subheader("2. Rack Dimensions & Bin/Level Capacity")
-                    num_racks = st.number_input("Number of Racks (per station)", min_value=1, value=1, step=1)
+                # Widgets inside the form don't trigger a rerun until submit; the rack count stays outside
+                # because it decides how many rack sections are rendered.
+                num_racks = st.number_input("Number of Racks (per station)", min_value=1, value=1, step=1)
+
+                with st.form("label_setup"):
+                    with st.expander("⚙️ Step 1: Configure Dimensions and Rack Setup (Applied to Each Station)", expanded=True):
                     
-                    rack_configs = {}
-                    rack_dims = {}
-                    for i in range(num_racks):
-                        rack_name = f"Rack {i+1:02d}"
-                        col1, col2 = st.columns(2)
+                        st.subheader("1. Container Dimensions")
+                        bin_dims = {}
+                        for container in unique_containers:
+                            dim = st.text_input(f"Dimensions for {container}", key=f"bindim_{container}", placeholder="e.g., 300x200x150mm")
+                            bin_dims[container] = dim
+                        st.markdown("---")
+
+                        st.subheader("2. Rack Dimensions & Bin/Level Capacity")
+                        rack_configs = {}
+                        rack_dims = {}
+                        for i in range(num_racks):
+                            rack_name = f"Rack {i+1:02d}"
+                            col1, col2 = st.columns(2)
                         
-                        with col1:
-                            st.markdown(f"**Settings for {rack_name}**")
-                            r_dim = st.text_input(f"Dimensions for {rack_name}", key=f"rackdim_{rack_name}", placeholder="e.g., 1200x1000x2000mm")
-                            rack_dims[rack_name] = r_dim
-                            levels = st.multiselect(f"Available Levels for {rack_name}",
-                                options=['A','B','C','D','E','F','G','H'], default=['A','B','C','D','E'], key=f"levels_{rack_name}")
+                            with col1:
+                                st.markdown(f"**Settings for {rack_name}**")
+                                r_dim = st.text_input(f"Dimensions for {rack_name}", key=f"rackdim_{rack_name}", placeholder="e.g., 1200x1000x2000mm")
+                                rack_dims[rack_name] = r_dim
+                                levels = st.multiselect(f"Available Levels for {rack_name}",
+                                    options=['A','B','C','D','E','F','G','H'], default=['A','B','C','D','E'], key=f"levels_{rack_name}")
                         
-                        with col2:
-                            st.markdown(f"**Bin Capacity Per Level for {rack_name}**")
-                            rack_bin_counts = {}
-                            for container in unique_containers:
-                                b_count = st.number_input(f"Capacity of '{container}' Bins", min_value=0, value=0, step=1, key=f"bcount_{rack_name}_{container}")
-                                if b_count > 0: rack_bin_counts[container] = b_count
+                            with col2:
+                                st.markdown(f"**Bin Capacity Per Level for {rack_name}**")
+                                rack_bin_counts = {}
+                                for container in unique_containers:
+                                    b_count = st.number_input(f"Capacity of '{container}' Bins", min_value=0, value=0, step=1, key=f"bcount_{rack_name}_{container}")
+                                    if b_count > 0: rack_bin_counts[container] = b_count
                         
-                        rack_configs[rack_name] = {'dimensions': r_dim, 'levels': levels, 'rack_bin_counts': rack_bin_counts}
-                        st.markdown("---")
+                            rack_configs[rack_name] = {'dimensions': r_dim, 'levels': levels, 'rack_bin_counts': rack_bin_counts}
+                            st.markdown("---")
+
+                    submitted = st.form_submit_button("🚀 Generate PDF Labels", type="primary")
 
-                if st.button("🚀 Generate PDF Labels", type="primary"):
+                if submitted:
                     missing_bin_dims = [name for name, dim in bin_dims.items() if not dim]
                     missing_rack_dims = [name for name, dim in rack_dims.items() if not dim]
                     
@@ -527,7 +628,7 @@ def main():
                         progress_bar = st.progress(0)
                         status_text = st.empty()
                         try:
-                            df_processed = automate_location_assignment(df, base_rack_id, rack_configs, status_text)
+                            df_processed = automate_location_assignment(df, base_rack_id, rack_configs, status_text, required_cols_check)
                             
                             if df_processed is not None and not df_processed.empty:
                                 pdf_buffer, label_summary = None, {}